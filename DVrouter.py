@@ -6,10 +6,16 @@
 
 from router import Router
 from packet import Packet
+from collections import defaultdict
 import json
 import time
 
 
+def encode(data):
+    """Serialize `data` as JSON, without spaces after the separators."""
+    return json.dumps(data, separators=(",", ":"))
+
+
 class DVrouter(Router):
     """Distance vector routing protocol implementation."""
 
@@ -26,59 +32,83 @@ class DVrouter(Router):
         # Neighbors: maps port to (neighbor_addr, cost)
         self.neighbors = {}
 
+        # Reverse index of neighbors: maps neighbor_addr to the port of the
+        # cheapest link to it, as there may be several
+        self.endpoint_to_port = {}
+
         # Neighbor DVs: maps neighbor_addr to their distance vector
         self.neighbor_dvs = {}
 
+        # Last raw DV packet content received from each neighbor
+        self.neighbor_dv_payloads = {}
+
+        # All destinations we may be able to reach: maps destination to the
+        # number of neighbor DVs and direct links that include it
+        self.all_destinations = {}
+
         # Forwarding table: maps destination to outgoing port
         self.forwarding_table = {}
 
+        # String representation of the router state, cleared whenever it changes
+        self.str_cache = None
+
     def handle_packet(self, port, packet):
         """Process incoming packet."""
         if packet.is_traceroute:
             # Handle data packet using forwarding table
-            if packet.dst_addr in self.forwarding_table:
-                out_port = self.forwarding_table[packet.dst_addr]
-                self.send(out_port, packet)
+            out_port = self.forwarding_table.get(packet.dst_addr)
             # Check if this packet is destined for a client directly connected to us
             # by checking if the destination is a neighbor
-            else:
-                for p, (neighbor, _) in self.neighbors.items():
-                    if neighbor == packet.dst_addr:
-                        self.send(p, packet)
-                        return
+            if out_port is None:
+                out_port = self.endpoint_to_port.get(packet.dst_addr)
+            if out_port is not None:
+                self.send(out_port, packet)
         else:
             # Handle routing packet (distance vector)
+            if port not in self.neighbors:
+                return
+            neighbor_addr = self.neighbors[port][0]
+
+            # Periodic broadcasts usually repeat the last DV verbatim, in
+            # which case there is nothing to parse or compare
+            if self.neighbor_dv_payloads.get(neighbor_addr) == packet.content:
+                return
             try:
-                neighbor_addr = self.neighbors[port][0]
                 received_dv = json.loads(packet.content)
-
-                # Check if this is a new neighbor or if the DV has changed
-                dv_changed = False
-                if neighbor_addr not in self.neighbor_dvs:
-                    dv_changed = True
-                else:
-                    # Check if the DV has changed
-                    old_dv = self.neighbor_dvs[neighbor_addr]
-                    for dest, cost in received_dv.items():
-                        if dest not in old_dv or old_dv[dest] != cost:
-                            dv_changed = True
-                            break
-
-                # Store neighbor's distance vector
-                self.neighbor_dvs[neighbor_addr] = received_dv
-
-                # Update our distance vector if the neighbor's DV changed
-                if dv_changed and self.update_distance_vector():
-                    # If our DV changed, broadcast it
-                    self.broadcast_dv()
-            except Exception as e:
-                # Handle parsing errors
-                pass
+            except ValueError:
+                return  # Ignore malformed packets
+            if not isinstance(received_dv, dict):
+                return
+
+            # Find the destinations whose cost through this neighbor changed
+            old_dv = self.neighbor_dvs.get(neighbor_addr)
+            if old_dv is None:
+                changed = set(received_dv)
+                self.count_destinations(received_dv, 1)
+            else:
+                changed = {dest for dest, cost in received_dv.items()
+                           if old_dv.get(dest) != cost}
+                removed = old_dv.keys() - received_dv.keys()
+                changed.update(removed)
+                self.count_destinations(received_dv.keys() - old_dv.keys(), 1)
+                self.count_destinations(removed, -1)
+
+            # Store neighbor's distance vector
+            self.neighbor_dvs[neighbor_addr] = received_dv
+            self.neighbor_dv_payloads[neighbor_addr] = packet.content
+
+            # Update our distance vector for the changed destinations only
+            if changed and self.update_distance_vector(changed):
+                # If our DV changed, broadcast it
+                self.broadcast_dv()
 
     def handle_new_link(self, port, endpoint, cost):
         """Handle new link."""
         # Store new neighbor information
         self.neighbors[port] = (endpoint, cost)
+        self.index_endpoint(endpoint)
+        self.count_destinations((endpoint,), 1)
+        self.str_cache = None
 
         # Update our distance vector with the direct path to the new neighbor
         updated = False
@@ -91,13 +121,10 @@ class DVrouter(Router):
         updated = self.update_distance_vector() or updated
 
         # Always broadcast our DV to all neighbors when a new link is added
-        # This ensures that all routers are aware of the new link
+        # This ensures that all routers are aware of the new link, and also
+        # requests the new neighbor's DV by sending our DV to it
         self.broadcast_dv()
 
-        # Request the new neighbor's DV by sending our DV to it
-        if port in self.neighbors:
-            self.send_dv_to_neighbor(port)
-
     def handle_remove_link(self, port):
         """Handle removed link."""
         if port not in self.neighbors:
@@ -107,9 +134,13 @@ class DVrouter(Router):
         neighbor_addr = self.neighbors[port][0]
 
         # Remove neighbor information
+        self.str_cache = None
         del self.neighbors[port]
-        if neighbor_addr in self.neighbor_dvs:
-            del self.neighbor_dvs[neighbor_addr]
+        if self.endpoint_to_port.get(neighbor_addr) == port:
+            self.index_endpoint(neighbor_addr)
+        self.count_destinations((neighbor_addr,), -1)
+        self.count_destinations(self.neighbor_dvs.pop(neighbor_addr, ()), -1)
+        self.neighbor_dv_payloads.pop(neighbor_addr, None)
 
         # Update distance vector and forwarding table
         updated = False
@@ -123,8 +154,7 @@ class DVrouter(Router):
         # Remove these routes from our DV
         for dest in routes_to_update:
             del self.dv[dest]
-            if dest in self.forwarding_table:
-                del self.forwarding_table[dest]
+            self.forwarding_table.pop(dest, None)
             updated = True
 
         # Recalculate distance vector to find alternative paths
@@ -144,22 +174,32 @@ class DVrouter(Router):
         if time_ms - self.last_sent >= self.heartbeat_time:
             # Recalculate distance vector before broadcasting
             self.update_distance_vector()
+
+            # DV packets carry no sequence number and may arrive out of order,
+            # so resend ours every heartbeat to replace any stale copy a
+            # neighbor still holds
             self.broadcast_dv()
             self.last_sent = time_ms
 
-    def update_distance_vector(self):
+    def update_distance_vector(self, dirty_dests=None):
         """Update distance vector based on neighbors' DVs.
-        Returns True if DV was changed, False otherwise."""
+        Only the destinations in `dirty_dests` are recomputed if given, otherwise
+        all known destinations are. Returns True if DV was changed, False otherwise."""
         updated = False
 
-        # For each destination in any neighbor's DV
-        all_destinations = set()
-        for neighbor_dv in self.neighbor_dvs.values():
-            all_destinations.update(neighbor_dv.keys())
+        if dirty_dests is not None:
+            all_destinations = dirty_dests
+        else:
+            # Every destination in any neighbor's DV or directly connected to us
+            all_destinations = self.all_destinations
 
-        # Add our direct neighbors
-        for port, (endpoint, cost) in self.neighbors.items():
-            all_destinations.add(endpoint)
+        # Pair each neighbor's DV with the port and cost to reach it once, so the
+        # relaxation below is a single lookup per neighbor and destination
+        neighbor_paths = [
+            (port, direct_cost, self.neighbor_dvs[neighbor])
+            for port, (neighbor, direct_cost) in self.neighbors.items()
+            if neighbor in self.neighbor_dvs
+        ]
 
         # For each possible destination
         for dest in all_destinations:
@@ -167,83 +207,107 @@ class DVrouter(Router):
                 continue  # Skip ourselves
 
             # Find best path through neighbors
-            best_cost = float('inf')
+            best_cost = 16  # Infinity value
             best_port = None
 
             # Check direct neighbors first
-            for port, (endpoint, cost) in self.neighbors.items():
-                if endpoint == dest and cost < best_cost:
-                    best_cost = cost
-                    best_port = port
+            if dest in self.endpoint_to_port:
+                best_port = self.endpoint_to_port[dest]
+                best_cost = self.neighbors[best_port][1]
 
             # Then check paths through neighbors
-            for port, (neighbor, direct_cost) in self.neighbors.items():
-                if neighbor in self.neighbor_dvs and dest in self.neighbor_dvs[neighbor]:
-                    # Calculate cost through this neighbor
-                    neighbor_cost = self.neighbor_dvs[neighbor][dest]
+            for port, direct_cost, neighbor_dv in neighbor_paths:
+                # Calculate cost through this neighbor, treating unknown
+                # destinations as infinity (16)
+                neighbor_cost = neighbor_dv.get(dest, 16)
 
-                    # Skip if neighbor reports infinity (16)
-                    if neighbor_cost >= 16:
-                        continue
+                # Skip if neighbor reports infinity (16)
+                if neighbor_cost >= 16:
+                    continue
 
-                    total_cost = direct_cost + neighbor_cost
+                total_cost = direct_cost + neighbor_cost
 
-                    # Avoid count-to-infinity problem
-                    if total_cost < best_cost and total_cost < 16:  # Infinity value
-                        best_cost = total_cost
-                        best_port = port
+                # Avoid count-to-infinity problem
+                if total_cost < best_cost and total_cost < 16:  # Infinity value
+                    best_cost = total_cost
+                    best_port = port
 
-            # Update our DV if we found a better path or if this is a new destination
-            if best_port is not None and (dest not in self.dv or self.dv[dest][0] > best_cost):
+            # Update our DV if the best path changed or if this is a new destination.
+            # This includes paths that got worse, e.g. when the neighbor we route
+            # through reports a higher cost
+            if best_port is not None and self.dv.get(dest) != (best_cost, best_port):
                 self.dv[dest] = (best_cost, best_port)
                 self.forwarding_table[dest] = best_port
                 updated = True
             # If we can no longer reach a destination that was in our DV
             elif best_port is None and dest in self.dv:
                 del self.dv[dest]
-                if dest in self.forwarding_table:
-                    del self.forwarding_table[dest]
+                self.forwarding_table.pop(dest, None)
                 updated = True
 
+        if updated:
+            self.str_cache = None
         return updated
 
+    def index_endpoint(self, endpoint):
+        """Point endpoint_to_port at the cheapest remaining link to `endpoint`, if any."""
+        ports = [port for port, (neighbor, _) in self.neighbors.items() if neighbor == endpoint]
+        if ports:
+            self.endpoint_to_port[endpoint] = min(ports, key=lambda port: self.neighbors[port][1])
+        else:
+            self.endpoint_to_port.pop(endpoint, None)
+
+    def count_destinations(self, dests, delta):
+        """Add `delta` to the reference counts of `dests` in all_destinations."""
+        for dest in dests:
+            count = self.all_destinations.get(dest, 0) + delta
+            if count > 0:
+                self.all_destinations[dest] = count
+            else:
+                del self.all_destinations[dest]
+
     def broadcast_dv(self):
         """Broadcast distance vector to all neighbors."""
         # Always include our own address with cost 0
         self.dv[self.addr] = (0, None)
 
-        # Create a simplified DV with just costs
+        # Create a simplified DV with just costs, built once for all neighbors,
+        # and group the routes by the port they go through
         simplified_dv = {}
-        for dest, (cost, _) in self.dv.items():
+        routes_by_port = defaultdict(dict)
+        for dest, (cost, out_port) in self.dv.items():
             simplified_dv[dest] = cost
+            routes_by_port[out_port][dest] = cost
 
-        # Send to each neighbor
+        # Send to each neighbor, serializing only once for all neighbors
+        # that don't need any poisoned entries
+        unpoisoned = None
         for port in self.neighbors:
-            self.send_dv_to_neighbor(port)
-
-    def send_dv_to_neighbor(self, port):
-        """Send distance vector to a specific neighbor."""
-        # Create a simplified DV with just costs
-        simplified_dv = {}
-
-        # Always include our own address with cost 0
-        simplified_dv[self.addr] = 0
-
-        for dest, (cost, out_port) in self.dv.items():
-            # Split horizon with poison reverse
-            if out_port == port:
-                simplified_dv[dest] = 16  # "Infinity"
-            else:
-                simplified_dv[dest] = cost
-
-        # Create and send packet
+            poisoned = routes_by_port.get(port)
+            if not poisoned:
+                if unpoisoned is None:
+                    unpoisoned = encode(simplified_dv)
+                self.send_dv_to_neighbor(port, unpoisoned)
+                continue
+
+            # Split horizon with poison reverse: patch the routes through
+            # this neighbor to "infinity", serialize, then restore them, each
+            # as a single bulk update
+            simplified_dv.update(dict.fromkeys(poisoned, 16))
+            payload = encode(simplified_dv)
+            simplified_dv.update(poisoned)
+            self.send_dv_to_neighbor(port, payload)
+
+    def send_dv_to_neighbor(self, port, payload):
+        """Send a serialized distance vector to a specific neighbor."""
         if port in self.neighbors:  # Check if the neighbor still exists
-            packet = Packet(Packet.ROUTING, self.addr, self.neighbors[port][0],
-                            json.dumps(simplified_dv))
+            packet = Packet(Packet.ROUTING, self.addr, self.neighbors[port][0], payload)
             self.send(port, packet)
 
     def __str__(self):
         """Return a string representation of the router state."""
+        if self.str_cache is not None:
+            return self.str_cache
         result = f"Router {self.addr}\n"
         result += "Distance Vector:\n"
         for dest, (cost, port) in sorted(self.dv.items()):
@@ -251,4 +315,5 @@ class DVrouter(Router):
         result += "Forwarding Table:\n"
         for dest, port in sorted(self.forwarding_table.items()):
             result += f"  {dest} -> port {port}\n"
+        self.str_cache = result
         return result
@@ -8,7 +8,15 @@ from router import Router
 from packet import Packet
 import json
 import heapq
-import time
+
+# Fields every link state advertisement carries. Routing packets hold a JSON
+# list of these, so that several LSAs can be flooded in a single packet.
+LSA_KEYS = {"router", "seq", "links"}
+
+
+def encode(data):
+    """Serialize `data` as JSON, without spaces after the separators."""
+    return json.dumps(data, separators=(",", ":"))
 
 
 class LSrouter(Router):
@@ -26,48 +34,85 @@ class LSrouter(Router):
         self.heartbeat_time = heartbeat_time
         self.last_sent = 0
 
-        self.ls_db = {addr: {}}
+        # Every router and client we know of gets a small int id, with our own
+        # address always being id 0. The link state database is indexed by id,
+        # holding the links of each router as {neighbor_id: cost}, or None for
+        # nodes we have no LSA from.
+        self.id_of = {addr: 0}
+        self.addr_of = [addr]
+        self.ls_db = [{}]
+
         self.seq_nums = {addr: 0}
         self.neighbors = {}
+        # Port of the cheapest link to each neighbor, as there may be several
+        self.endpoint_to_port = {}
         self.forwarding_table = {}
-        self.packet_history = set()
+
+        # Shortest-path tree from the last Dijkstra run, keyed by node id and
+        # kept so that LSAs from other routers can be applied incrementally
+        self.distances = {0: 0}
+        self.predecessors = {}
+        self.first_hops = {}
+
+        # LSAs accepted since the last call to process_pending_lsas: maps the
+        # id of each router whose links changed to its links before the change,
+        # and the address of each router to (lsa, port it arrived on) to flood
+        self.pending_lsas = {}
+        self.pending_floods = {}
+
+        # Serialized copy of our own LSA as (seq, payload), reused until our
+        # links change and bump our sequence number
+        self.lsa_cache = (None, None)
+
+        # String representation of the router state, cleared whenever it changes
+        self.str_cache = None
 
     def handle_packet(self, port, packet):
         """Process incoming packet."""
         if packet.is_traceroute:
-            if packet.dst_addr in self.forwarding_table:
-                out_port = self.forwarding_table[packet.dst_addr]
+            out_port = self.forwarding_table.get(packet.dst_addr)
+            if out_port is None:
+                out_port = self.endpoint_to_port.get(packet.dst_addr)
+            if out_port is not None:
                 self.send(out_port, packet)
-            else:
-                for p, (neighbor, _) in self.neighbors.items():
-                    if neighbor == packet.dst_addr:
-                        self.send(p, packet)
-                        return
         else:
             try:
-                ls_data = json.loads(packet.content)
+                lsas = json.loads(packet.content)
+            except ValueError:
+                return  # Ignore malformed packets
+            if not isinstance(lsas, list):
+                return
+
+            for ls_data in lsas:
+                if not isinstance(ls_data, dict) or not LSA_KEYS <= ls_data.keys():
+                    continue
+
                 router_addr = ls_data["router"]
                 seq_num = ls_data["seq"]
                 link_state = ls_data["links"]
 
-                if (router_addr, seq_num) in self.packet_history:
-                    return
-
-                self.packet_history.add((router_addr, seq_num))
-
+                # Only the newest LSA from each router matters, so the latest
+                # sequence number seen also suppresses duplicates
                 if (router_addr not in self.seq_nums or seq_num > self.seq_nums[router_addr]):
                     self.seq_nums[router_addr] = seq_num
-                    self.ls_db[router_addr] = link_state
-                    self.calculate_forwarding_table()
-                    self.flood_packet(packet, port)
-            except Exception as e:
-                pass
+                    self.str_cache = None
+                    router_id = self.node_id(router_addr)
+                    new_links = {self.node_id(dest): cost for dest, cost in link_state.items()}
+                    old_links = self.ls_db[router_id] or {}
+                    self.ls_db[router_id] = new_links
+
+                    # Defer the forwarding table update and the flood to
+                    # handle_time, so that LSAs arriving together are handled
+                    # together
+                    self.pending_lsas.setdefault(router_id, old_links)
+                    self.pending_floods[router_addr] = (ls_data, port)
 
     def handle_new_link(self, port, endpoint, cost):
         """Handle new link."""
         self.neighbors[port] = (endpoint, cost)
-        self.ls_db[self.addr][endpoint] = cost
+        self.index_endpoint(endpoint)
         self.seq_nums[self.addr] += 1
+        self.str_cache = None
         self.calculate_forwarding_table()
         self.broadcast_link_state()
 
@@ -78,81 +123,207 @@ class LSrouter(Router):
 
         neighbor_addr = self.neighbors[port][0]
         del self.neighbors[port]
-
-        if neighbor_addr in self.ls_db[self.addr]:
-            del self.ls_db[self.addr][neighbor_addr]
+        if self.endpoint_to_port.get(neighbor_addr) == port:
+            self.index_endpoint(neighbor_addr)
 
         self.seq_nums[self.addr] += 1
+        self.str_cache = None
         self.calculate_forwarding_table()
         self.broadcast_link_state()
 
     def handle_time(self, time_ms):
         """Handle periodic tasks."""
+        if self.pending_lsas or self.pending_floods:
+            self.process_pending_lsas()
+
         if time_ms - self.last_sent >= self.heartbeat_time:
             self.broadcast_link_state()
             self.last_sent = time_ms
 
+    def index_endpoint(self, endpoint):
+        """Point endpoint_to_port, and our link to `endpoint`, at the cheapest remaining link to it."""
+        ports = [port for port, (neighbor, _) in self.neighbors.items() if neighbor == endpoint]
+        if ports:
+            port = min(ports, key=lambda port: self.neighbors[port][1])
+            self.endpoint_to_port[endpoint] = port
+            self.ls_db[0][self.node_id(endpoint)] = self.neighbors[port][1]
+        else:
+            del self.endpoint_to_port[endpoint]
+            self.ls_db[0].pop(self.id_of[endpoint], None)
+
+    def node_id(self, addr):
+        """Return the id of `addr`, assigning it the next free one if it is new."""
+        if addr not in self.id_of:
+            self.id_of[addr] = len(self.addr_of)
+            self.addr_of.append(addr)
+            self.ls_db.append(None)
+        return self.id_of[addr]
+
     def calculate_forwarding_table(self):
         """Calculate forwarding table using Dijkstra's algorithm."""
+        self.distances = {0: 0}
+        self.predecessors = {}
+        self.first_hops = {}
         self.forwarding_table = {}
+        self.pending_lsas = {}
+        self.run_dijkstra([(0, 0)])
 
-        distances = {self.addr: 0}
-        predecessors = {}
-        first_hops = {}
-        pq = [(0, self.addr)]
+    def process_pending_lsas(self):
+        """Update the forwarding table for, and flood, the LSAs accepted since the last call."""
+        if self.pending_lsas:
+            self.str_cache = None
+            # The shortest-path tree can only be repaired one LSA at a time, so
+            # fall back to a single full run when several routers changed
+            if len(self.pending_lsas) == 1 and 0 not in self.pending_lsas:
+                (router_id, old_links), = self.pending_lsas.items()
+                self.pending_lsas = {}
+                self.update_forwarding_table(router_id, old_links, self.ls_db[router_id])
+            else:
+                self.calculate_forwarding_table()
+
+        # Send each neighbor one packet with every pending LSA, except those it
+        # sent us or originated itself
+        payloads = {}
+        for port, (neighbor, _) in self.neighbors.items():
+            routers = tuple(
+                router for router, (_, in_port) in self.pending_floods.items()
+                if in_port != port and router != neighbor
+            )
+            if not routers:
+                continue
+            if routers not in payloads:
+                lsas = [self.pending_floods[router][0] for router in routers]
+                payloads[routers] = encode(lsas)
+            self.send(port, Packet(Packet.ROUTING, self.addr, neighbor, payloads[routers]))
+        self.pending_floods = {}
+
+    def update_forwarding_table(self, router_id, old_links, new_links):
+        """Update the forwarding table after router `router_id` changed its links.
+
+        Only the part of the shortest-path tree affected by the change is
+        recomputed: subtrees hanging off links that got worse or disappeared
+        are invalidated and re-seeded from their remaining neighbors, and links
+        that got better are relaxed directly.
+        """
+        distances = self.distances
+        predecessors = self.predecessors
+        pq = []
+
+        # Subtrees reached through a link of router_id that got worse or was removed
+        roots = [
+            dest for dest, cost in old_links.items()
+            if predecessors.get(dest) == router_id
+            and (dest not in new_links or new_links[dest] > cost)
+        ]
+        if roots:
+            children = {}
+            for node, pred in predecessors.items():
+                children.setdefault(pred, []).append(node)
+
+            affected = set()
+            stack = roots
+            while stack:
+                node = stack.pop()
+                if node not in affected:
+                    affected.add(node)
+                    stack.extend(children.get(node, ()))
+
+            for node in affected:
+                del distances[node]
+                del predecessors[node]
+                if self.first_hops.pop(node, None) is not None:
+                    del self.forwarding_table[self.addr_of[node]]
+
+            # Re-seed affected nodes from their unaffected neighbors
+            for router, links in enumerate(self.ls_db):
+                if links and router in distances:
+                    for dest, cost in links.items():
+                        if dest in affected:
+                            self.relax(router, dest, distances[router] + cost, pq)
+
+        # Links of router_id that got better or were added
+        if router_id in distances:
+            dist = distances[router_id]
+            for dest, cost in new_links.items():
+                if dest not in old_links or cost < old_links[dest]:
+                    self.relax(router_id, dest, dist + cost, pq)
+
+        self.run_dijkstra(pq)
+
+    def run_dijkstra(self, pq):
+        """Run Dijkstra's algorithm from the (distance, node) entries in `pq`."""
+        # Bind the heap functions and state locally so the inner loop only
+        # dispatches into Python for edges that actually shorten a path
+        heappop = heapq.heappop
+        distances = self.distances
+        ls_db = self.ls_db
+        relax = self.relax
+        visited = set()
 
         while pq:
-            dist, current = heapq.heappop(pq)
+            dist, current = heappop(pq)
 
-            if current in distances and dist > distances[current]:
+            # The first entry popped for a node has its final distance, any
+            # later ones are stale
+            if current in visited:
                 continue
+            visited.add(current)
 
-            if current in self.ls_db:
-                for neighbor, cost in self.ls_db[current].items():
+            links = ls_db[current]
+            if links:
+                for neighbor, cost in links.items():
                     new_dist = dist + cost
-
                     if neighbor not in distances or new_dist < distances[neighbor]:
-                        distances[neighbor] = new_dist
-                        predecessors[neighbor] = current
+                        relax(current, neighbor, new_dist, pq)
 
-                        if current == self.addr:
-                            for port, (endpoint, _) in self.neighbors.items():
-                                if endpoint == neighbor:
-                                    first_hops[neighbor] = port
-                        elif current in first_hops:
-                            first_hops[neighbor] = first_hops[current]
+    def relax(self, current, neighbor, new_dist, pq):
+        """Record `current` as the predecessor of `neighbor` if it is a shorter path."""
+        if neighbor in self.distances and new_dist >= self.distances[neighbor]:
+            return
 
-                        heapq.heappush(pq, (new_dist, neighbor))
+        self.distances[neighbor] = new_dist
+        self.predecessors[neighbor] = current
+
+        if current == 0:
+            port = self.endpoint_to_port.get(self.addr_of[neighbor])
+        else:
+            port = self.first_hops.get(current)
+        if port is not None:
+            self.first_hops[neighbor] = port
+            self.forwarding_table[self.addr_of[neighbor]] = port
 
-        self.forwarding_table = first_hops
+        heapq.heappush(pq, (new_dist, neighbor))
 
     def broadcast_link_state(self):
         """Broadcast link state to all neighbors."""
-        ls_data = {
-            "router": self.addr,
-            "seq": self.seq_nums[self.addr],
-            "links": self.ls_db[self.addr]
-        }
-
+        seq = self.seq_nums[self.addr]
+        if self.lsa_cache[0] != seq:
+            ls_data = {
+                "router": self.addr,
+                "seq": seq,
+                "links": {self.addr_of[dest]: cost for dest, cost in self.ls_db[0].items()}
+            }
+            self.lsa_cache = (seq, encode([ls_data]))
+        # Links copy packets on send, so one packet can go out to every neighbor
+        packet = Packet(Packet.ROUTING, self.addr, None, self.lsa_cache[1])
         for port, (neighbor, _) in self.neighbors.items():
-            packet = Packet(Packet.ROUTING, self.addr, neighbor, json.dumps(ls_data))
+            packet.dst_addr = neighbor
             self.send(port, packet)
 
-        self.last_sent = int(time.time() * 1000)
-
-    def flood_packet(self, packet, exclude_port):
-        """Flood a link state packet to all neighbors except the one we received from."""
-        for port in self.neighbors:
-            if port != exclude_port:
-                self.send(port, packet)
-
     def __str__(self):
         """Return a string representation of the router state."""
+        if self.str_cache is not None:
+            return self.str_cache
         result = f"Router {self.addr}\n"
         result += "Link State Database:\n"
-        for router, links in sorted(self.ls_db.items()):
+        ls_db = {
+            self.addr_of[router]: {self.addr_of[dest]: cost for dest, cost in links.items()}
+            for router, links in enumerate(self.ls_db) if links is not None
+        }
+        for router, links in sorted(ls_db.items()):
             result += f"  {router}: {links}\n"
         result += "Forwarding Table:\n"
         for dest, port in sorted(self.forwarding_table.items()):
             result += f"  {dest} -> port {port}\n"
+        self.str_cache = result
         return result